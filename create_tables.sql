@@ -14,6 +14,10 @@ DROP
   TABLE IF EXISTS tick_data_received;
 DROP
   TABLE IF EXISTS file_log;
+DROP
+  TABLE IF EXISTS file_table_log;
+DROP
+  TABLE IF EXISTS dropped_index;
 CREATE TABLE "product" (
   "unique_id" SMALLSERIAL NOT NULL PRIMARY KEY,
   "symbol" varchar(4) NOT NULL,
@@ -83,6 +87,18 @@ CREATE TABLE "file_log" (
   "filename" varchar NOT NULL,
   "time" TIMESTAMP NOT NULL
 );
+CREATE TABLE "file_table_log" (
+  "unique_id" SERIAL NOT NULL PRIMARY KEY,
+  "filename" varchar NOT NULL,
+  "group_name" varchar(8) NOT NULL,
+  "table_name" varchar(9) NOT NULL,
+  "time" TIMESTAMP NOT NULL,
+  UNIQUE ("filename", "group_name", "table_name")
+);
+CREATE TABLE "dropped_index" (
+  "unique_id" SERIAL NOT NULL PRIMARY KEY,
+  "statement" varchar NOT NULL
+);
 SELECT
   create_hypertable('tick_data_match', 'unique_id', chunk_time_interval => 86400);
 SELECT
@@ -3,9 +3,9 @@ Method goes through the hierarchical file one member at a time, stores the data
 inserts directly into a PostgreSQL table
 
 Open the file
+  > add the symbol, currency and exchange of every table to the product database table, if not already added
   > for each 'group' (match, open, change, done)
-      > go to each table (BTC_USD, ETH_EUR etc.)
-          > add the symbol, currency and exchange to the product database table, if not already added
+      > go to each table (BTC_USD, ETH_EUR etc.), each one in its own worker process
           > if there is data in the table, extract it all into one 2d numpy array
           > convert the encoded raw byte data into float values and strings
           > add the product.unique_id to the array by looking it up from the product table
@@ -22,12 +22,17 @@ The resulting PostgreSQL database was 1,513MB
 
 import os
 import h5py
-import psycopg2.extras
+import psycopg
 import config
 import timeit
+import struct
+import queue
+import threading
+import multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
-from io import StringIO
+from io import BytesIO
 
 
 # TODO separate out the code that DROPs and CREATEs the tables so can either replace with new data, or keep appending
@@ -41,174 +46,481 @@ db_table_columns = {'match':    ('unique_id', 'product_id', 'side', 'time', 'pri
                                  'order_id'),
                     'received': ('unique_id', 'order_id', 'order_type', 'side')}
 
+# PostgreSQL type of each column, which decides how its values are packed into the binary COPY payload
+db_column_types = {'product_id': 'int8', 'side': 'text', 'time': 'timestamp', 'price': 'int8', 'size': 'float8',
+                   'remaining_size': 'float8', 'old_size': 'float8', 'new_size': 'float8', 'reason': 'text',
+                   'order_type': 'text', 'order_id': 'uuid', 'maker_order_id': 'uuid', 'taker_order_id': 'uuid'}
+db_table_types = {table: [db_column_types[column] for column in columns[1:]]
+                  for table, columns in db_table_columns.items()}
+# Column list of each COPY statement, e.g. "(order_id, order_type, side)". unique_id is left to its SERIAL default
+db_copy_columns = {table: '(' + ', '.join(columns[1:]) + ')' for table, columns in db_table_columns.items()}
 
-def divide(a, b):
-    """custom function to divide two numbers, used by numpy.vectorize"""
-    if b == 0:
-        return 0.0
-    return float(a)/b
+# Binary COPY framing: signature, flags field and header extension length, then a field count of -1 to end the data
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+# PostgreSQL sends TIMESTAMP as int64 microseconds since 2000-01-01 rather than the Unix epoch
+PG_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+# Big-endian NumPy dtype of each fixed-width value, as PostgreSQL's binary send functions lay them out
+pg_binary_dtypes = {'int8': '>i8', 'float8': '>f8', 'timestamp': '>i8', 'uuid': 'V16'}
+# Positions of the hyphens in a UUID string such as '123e4567-e89b-12d3-a456-426614174000', and of its 32 hex digits
+UUID_HYPHENS = [8, 13, 18, 23]
+UUID_HEX_DIGITS = [position for position in range(36) if position not in UUID_HYPHENS]
 
+# All-zero UUID strings standing in for an order ID field missing from the HDF5 data, see null_uuids
+_null_uuids = np.empty(0, dtype='S36')
 
-def assemble_data_as_string(h5, group, table, db_table):
+# Largest contiguous (unchunked) HDF5 dataset, in bytes, that is read into memory with a single read rather than one
+# read per chunk of rows. It is still packed and COPYed in chunks of rows
+CONTIGUOUS_READ_BYTES = 512*1024*1024
+
+# Most worker processes loading tables at once. Each one can hold about 1GB: its 256MB HDF5 chunk cache, a 1M-row
+# record buffer and converted column buffers, up to four packed COPY payloads and the temporaries used in packing them,
+# plus up to CONTIGUOUS_READ_BYTES when it reads a contiguous dataset whole
+MAX_WORKERS = 4
+
+
+def connect_to_database():
+    """Make a new connection to the database given in config"""
+    return psycopg.connect(dbname=config.DB_NAME, user=config.DB_USER, password=config.DB_PASS, host=config.DB_HOST)
+
+
+def ingest_table(file_path, group, table, db_table, product_id):
+    """Worker process for one (group, table) dataset of the HDF5 file at 'file_path'.
+    Each worker opens the file read-only and connects to the database itself, as neither a h5py file nor a database
+    connection can be shared between processes, then COPYs the dataset in its own transaction and commits it.
+    The same transaction records the (file, group, table) in file_table_log, so a table is either loaded and recorded
+    or neither, and a rerun after a failure can skip exactly the tables that were committed"""
+    # A 256MB chunk cache (rather than the 1MB default) keeps a row slice's HDF5 chunks resident, so a chunk that
+    # straddles two slices is not read and decompressed twice
+    with h5py.File(file_path, 'r', rdcc_nbytes=256*1024*1024, rdcc_nslots=1000003, rdcc_w0=0.75) as h5, \
+            connect_to_database() as conn:
+        cur = conn.cursor()
+        # Nothing needs to wait for the WAL to be flushed to disk until the single commit at the end of the table
+        cur.execute('SET LOCAL synchronous_commit = OFF;')
+        assemble_data_as_string(h5, group, table, db_table, cur, product_id)
+        cur.execute('INSERT INTO file_table_log (unique_id, filename, group_name, table_name, time) '
+                    'VALUES (DEFAULT, %s, %s, %s, %s)', (file_path, group, table, datetime.now(tz=None)))
+
+
+def assemble_data_as_string(h5, group, table, db_table, cur, product_id):
     """Given the inputs of a HDF5 file, the group and table of the dataset within that file and the database table this
-    data is to be inserted into, extract each column from the HDF5 dataset as arrays.
-    Combine the arrays into a string of newline separated tuples (CSV format)
-    Write the string to a file-like object (StringIO)
-    Use Psycopg2 copy_expert to combine a PostgreSQL COPY statement with the file-like object to do a fast COPY
-    directly into the database"""
+    data is to be inserted into, COPY the data directly into the database through the cursor 'cur' one chunk at a time.
+    The two stages run as a pipeline: this thread reads and packs the next chunk (produce_sio_for_chunks) while a
+    background thread is still sending the previous one to PostgreSQL (copy_chunks)"""
+    copy_queue = queue.Queue(maxsize=2)
+    # The BytesIO objects are recycled between chunks. One more than can be held by the queue and the consumer at once
+    # means the producer always has one to fill
+    free_buffers = queue.Queue()
+    for _ in range(copy_queue.maxsize + 2):
+        free_buffers.put(BytesIO())
+    errors = []
+    consumer = threading.Thread(target=copy_chunks, args=(cur, copy_queue, free_buffers, errors))
+    consumer.start()
+    try:
+        for sio, sql in produce_sio_for_chunks(h5, group, table, db_table, product_id, free_buffers):
+            if errors:  # Stop reading the file once a COPY has failed
+                break
+            copy_queue.put((sio, sql))
+    finally:
+        copy_queue.put(None)  # Sentinel telling the consumer there are no more chunks
+        consumer.join()
+    if errors:
+        raise errors[0]
+
+
+def copy_chunks(cur, copy_queue, free_buffers, errors):
+    """Consumer side of the pipeline: take (file-like object, COPY statement) pairs from the queue and use the Psycopg
+    cursor 'cur' to COPY each one into the database, until the None sentinel arrives. Each file-like object is
+    handed back to 'free_buffers' once it has been sent.
+    An exception is kept in 'errors' for the producer to re-raise, and the rest of the queue is drained so the producer
+    never blocks on a full queue"""
+    while True:
+        item = copy_queue.get()
+        if item is None:
+            return
+        sio, sql = item
+        if not errors:
+            try:
+                # getvalue() shares the BytesIO's own buffer rather than copying it
+                with cur.copy(sql) as copy:
+                    copy.write(sio.getvalue())
+            except Exception as error:
+                errors.append(error)
+        free_buffers.put(sio)
+
+
+def produce_sio_for_chunks(h5, group, table, db_table, product_id, free_buffers):
+    """Producer side of the pipeline: extract each column of the HDF5 dataset as arrays, one chunk of rows at a time.
+    Pack the arrays into a PostgreSQL binary COPY payload
+    Write the payload to a file-like object (BytesIO) taken from 'free_buffers'
+    Yield the file-like object together with the COPY statement it is to be used with"""
     chunk = 1000000
-    number_of_rows = len(h5[group + '/' + table])
+    ds = h5[group + '/' + table]
+    number_of_rows = len(ds)
+    chunk_rows = min(chunk, number_of_rows)
+    # A contiguous dataset is one run of bytes on disk, so reading it in slices only adds system calls and selection
+    # overhead. When it fits in the memory budget it is read whole up front, and each chunk below is a slice of it, so
+    # packing and COPYing still overlap chunk by chunk
+    read_whole = ds.chunks is None and chunk < number_of_rows <= CONTIGUOUS_READ_BYTES // ds.dtype.itemsize
+    if read_whole:
+        buf = np.empty((number_of_rows,), dtype=ds.dtype)
+        ds.read_direct(buf)
+    else:
+        # One record buffer is reused for every chunk so HDF5 reads straight into it instead of allocating a new array
+        buf = np.empty((chunk_rows,), dtype=ds.dtype)
     size_array, maker_order_id_array, taker_order_id_array, remaining_size_array, order_id_array, old_size_array, \
     new_size_array, reason_array = [0, 0, 0, 0, 0, 0, 0, 0]
+    # Everything that only depends on the table is worked out once, not on every chunk
+    db_table_name = db_table[10:]
+    pg_types = db_table_types[db_table_name]
+    has_tick_columns = db_table_name in ['match', 'open', 'done', 'change']
+    has_order_id = db_table_name in ['open', 'done', 'change', 'received']
+    has_remaining_size = db_table_name in ['open', 'done']
+    # Populate SQL statement with database table column names
+    # e.g. "COPY table (column 1, column2, column3 etc) FROM STDIN WITH (FORMAT BINARY)"
+    sql = "COPY {} {} FROM STDIN WITH (FORMAT BINARY)".format(db_table, db_copy_columns[db_table_name])
+    # The columns that are converted rather than used as views of 'buf' also get buffers allocated once here, which
+    # every chunk refills in place
+    timestamp_buf = np.empty(chunk_rows, dtype='datetime64[us]')
+    scaled_bufs = {column: np.empty(chunk_rows, dtype=np.float64) for column in db_table_columns[db_table_name]
+                   if column in ['size', 'remaining_size', 'old_size', 'new_size']}
     for count in range(int(round((number_of_rows / chunk) + 0.5))):
         start = count * chunk
         if number_of_rows > start:  # If there are still rows left in the HDF5 file
-            end = (count + 1) * chunk  # i.e. list[start:end]
-            if number_of_rows < chunk:
-                end = number_of_rows  # If reaching the end of the dataset, reassign 'end' variable to the last row
-            # Gather data into separate arrays
-            db_table_name = db_table[10:]
-            if db_table_name in ['match', 'open', 'done', 'change']:
-                product_id_array = np.full(end, product_id)
-                side_array = np.char.decode(h5[group + '/' + table]['side'][start:end].astype(np.bytes_), 'UTF-8')
-                timestamp_array = np.vectorize(datetime.fromtimestamp)(h5[group + '/' + table]['time'][start:end] / 1e6).astype('str')
-                price_array = h5[group + '/' + table]['price'][start:end]
-            if db_table_name in ['open', 'done', 'change', 'received']:
+            # i.e. list[start:end], stopping at the last row when reaching the end of the dataset
+            end = min((count + 1) * chunk, number_of_rows)
+            n = end - start
+            # Read every column of the chunk in one pass as a compound record array, then take each field as a view
+            if read_whole:
+                rec = buf[start:end]
+            else:
+                ds.read_direct(buf, np.s_[start:end], np.s_[0:n])
+                rec = buf[:n]
+            # Gather data into separate arrays. String fields stay as the raw UTF-8 bytes stored in the HDF5 file, as
+            # that is what the binary COPY payload carries
+            side_array = rec['side']
+            if has_tick_columns:
+                # HDF5 'time' is microseconds since the epoch, which casts straight to datetime64[us]
+                np.copyto(timestamp_buf[:n], rec['time'], casting='unsafe')
+                timestamp_array = timestamp_buf[:n]
+                price_array = rec['price']
+            if has_order_id:
                 try:
-                    order_id_array = np.char.decode(h5[group + '/' + table]['order_id'][start:end].astype(np.bytes_), 'UTF-8')
+                    order_id_array = rec['order_id']
                 except ValueError:
-                    order_id_array = np.full(end, '00000000-0000-0000-0000-000000000000')
-            if db_table_name in ['match', 'open', 'done', 'change', 'received']:
-                side_array = np.char.decode(h5[group + '/' + table]['side'][start:end].astype(np.bytes_), 'UTF-8')
-            if db_table_name in ['open', 'done']:
-                remaining_size_array = np.vectorize(divide)(h5[group + '/' + table]['remaining_size'][start:end], 100000000)
+                    order_id_array = null_uuids(n)
+            if has_remaining_size:
+                remaining_size_array = np.divide(rec['remaining_size'], np.float64(100000000),
+                                                 out=scaled_bufs['remaining_size'][:n])
             if db_table_name == 'match':
-                size_array = np.vectorize(divide)(h5[group + '/' + table]['size'][start:end], 100000000)
+                size_array = np.divide(rec['size'], np.float64(100000000), out=scaled_bufs['size'][:n])
                 try:
-                    maker_order_id_array = np.char.decode(h5[group + '/' + table]['maker_order_id'][start:end].astype(np.bytes_), 'UTF-8')
+                    maker_order_id_array = rec['maker_order_id']
                 except ValueError:
-                    maker_order_id_array = np.full(end, '00000000-0000-0000-0000-000000000000')
+                    maker_order_id_array = null_uuids(n)
                 try:
-                    taker_order_id_array = np.char.decode(h5[group + '/' + table]['taker_order_id'][start:end].astype(np.bytes_), 'UTF-8')
+                    taker_order_id_array = rec['taker_order_id']
                 except ValueError:
-                    taker_order_id_array = np.full(end, '00000000-0000-0000-0000-000000000000')
+                    taker_order_id_array = null_uuids(n)
             if db_table_name == 'change':
-                old_size_array = np.vectorize(divide)(h5[group + '/' + table]['old_size'][start:end], 100000000)
-                new_size_array = np.vectorize(divide)(h5[group + '/' + table]['new_size'][start:end], 100000000)
+                old_size_array = np.divide(rec['old_size'], np.float64(100000000), out=scaled_bufs['old_size'][:n])
+                new_size_array = np.divide(rec['new_size'], np.float64(100000000), out=scaled_bufs['new_size'][:n])
             if db_table_name == 'done':
-                reason_array = np.char.decode(h5[group + '/' + table]['reason'][start:end].astype(np.bytes_), 'UTF-8')
+                reason_array = rec['reason']
             if db_table_name == 'received':
-                order_type_array = np.char.decode(h5[group + '/' + table]['order_type'][start:end].astype(np.bytes_), 'UTF-8')
-
-            # Write all relevant arrays to a StringIO file-like object
-            sio = StringIO()
-            if 'open' in db_table:
-                sio.writelines(arrays_to_CSV_string(
-                        arrays=[product_id_array, side_array, timestamp_array, price_array, remaining_size_array,
-                                order_id_array]))
-            if 'done' in db_table:
-                sio.writelines(arrays_to_CSV_string(
-                        arrays=[product_id_array, side_array, timestamp_array, price_array, remaining_size_array,
-                                reason_array, order_id_array]))
-            if 'match' in db_table:
-                sio.writelines(arrays_to_CSV_string(
-                        arrays=[product_id_array, side_array, timestamp_array, price_array, size_array,
-                                maker_order_id_array, taker_order_id_array]))
-            if 'change' in db_table:
-                sio.writelines(arrays_to_CSV_string(
-                        arrays=[product_id_array, side_array, timestamp_array, price_array, old_size_array,
-                                new_size_array, order_id_array]))
-            if 'received' in db_table:
-                sio.writelines(arrays_to_CSV_string(
-                        arrays=[order_id_array, order_type_array, side_array]))
+                order_type_array = rec['order_type']
 
+            # Write all relevant arrays to a BytesIO file-like object, overwriting what it held for an earlier chunk
+            sio = free_buffers.get()
             sio.seek(0)
-            # Populate SQL statement with database table column names
-            # e.g. "COPY table (column 1, column2, column3 etc) FROM STDIN WITH CSV HEADER"
-            sql = "COPY {} {} FROM STDIN WITH CSV HEADER"\
-                .format(db_table, str(db_table_columns[db_table[10:]][1:]).replace("'", ""))
-            # Copy long SQL statement to table as above
-            cur.copy_expert(sql, sio, size=8192)
+            if db_table_name == 'open':
+                arrays_to_binary_copy(
+                        sio, arrays=[product_id, side_array, timestamp_array, price_array, remaining_size_array,
+                                     order_id_array], pg_types=pg_types)
+            if db_table_name == 'done':
+                arrays_to_binary_copy(
+                        sio, arrays=[product_id, side_array, timestamp_array, price_array, remaining_size_array,
+                                     reason_array, order_id_array], pg_types=pg_types)
+            if db_table_name == 'match':
+                arrays_to_binary_copy(
+                        sio, arrays=[product_id, side_array, timestamp_array, price_array, size_array,
+                                     maker_order_id_array, taker_order_id_array], pg_types=pg_types)
+            if db_table_name == 'change':
+                arrays_to_binary_copy(
+                        sio, arrays=[product_id, side_array, timestamp_array, price_array, old_size_array,
+                                     new_size_array, order_id_array], pg_types=pg_types)
+            if db_table_name == 'received':
+                arrays_to_binary_copy(
+                        sio, arrays=[order_id_array, order_type_array, side_array], pg_types=pg_types)
+
+            sio.truncate()  # Drop anything left over from a longer earlier chunk
+            yield sio, sql
+
+
+def arrays_to_binary_copy(sio, arrays, pg_types):
+    """Pack arrays into one PostgreSQL binary COPY payload, written to the file-like object 'sio': the header, then per
+    row a 16-bit field count followed by each field as a 32-bit length and its big-endian value, then the trailer.
+    All rows are built at once as a NumPy structured array. Text values are stored padded to the longest value in the
+    column and, where lengths differ between rows, the padding bytes are masked out of the flattened result.
+    A scalar given in place of an array (e.g. the product_id) is broadcast to every row without being materialised"""
+    number_of_rows = next(len(array) for array in arrays if np.ndim(array))
+    fields = [('field_count', '>i2')]
+    values, lengths = [], []
+    for index, (array, pg_type) in enumerate(zip(arrays, pg_types)):
+        if pg_type == 'text':
+            value = array.astype(np.bytes_, copy=False)
+            length = np.char.str_len(value)
+            fields += [('length_{}'.format(index), '>i4'), ('value_{}'.format(index), value.dtype)]
+        else:
+            if pg_type == 'timestamp':
+                value = (array - PG_EPOCH).astype(np.int64)
+            elif pg_type == 'uuid':
+                value = uuids_to_bytes(array)
+            else:
+                value = array
+            length = np.dtype(pg_binary_dtypes[pg_type]).itemsize
+            fields += [('length_{}'.format(index), '>i4'), ('value_{}'.format(index), pg_binary_dtypes[pg_type])]
+        values.append(value)
+        lengths.append(length)
+
+    rows = np.empty(number_of_rows, dtype=fields)
+    rows['field_count'] = len(arrays)
+    for index, (value, length) in enumerate(zip(values, lengths)):
+        rows['length_{}'.format(index)] = length
+        rows['value_{}'.format(index)] = value
+    payload = rows.view(np.uint8).reshape(number_of_rows, rows.dtype.itemsize)
+
+    # Keep only the bytes of each text value that are really used by that row
+    keep = None
+    for index, length in enumerate(lengths):
+        field_dtype, offset = rows.dtype.fields['value_{}'.format(index)][:2]
+        if np.ndim(length) and length.min() < field_dtype.itemsize:
+            if keep is None:
+                keep = np.ones(payload.shape, dtype=bool)
+            keep[:, offset:offset + field_dtype.itemsize] = np.arange(field_dtype.itemsize) < length[:, None]
+    payload = payload.ravel() if keep is None else payload[keep]
+    # Write the array's buffer directly rather than joining it into one bytes object, which would copy it twice
+    sio.write(PGCOPY_HEADER)
+    sio.write(payload)
+    sio.write(PGCOPY_TRAILER)
+
 
+def uuids_to_bytes(array):
+    """Convert an array of 36 character UUID strings into the 16 raw bytes each, which is how PostgreSQL sends a UUID.
+    The hex digits are decoded for the whole array at once as a 2d array of characters: masking a digit's ASCII code
+    with 0x0F gives its value for '0'-'9', and letters (whose codes have bit 6 set) need 9 more. Anything other than a
+    hex digit or a hyphen in the right place raises a ValueError rather than being stored as the wrong UUID"""
+    characters = np.ascontiguousarray(array.astype('S36', copy=False)).view(np.uint8).reshape(-1, 36)
+    if not (characters[:, UUID_HYPHENS] == ord('-')).all():
+        raise ValueError('Found an order ID that is not a UUID string')
+    digits = characters[:, UUID_HEX_DIGITS]
+    # Setting bit 5 lower-cases a letter, so one range check covers both 'a'-'f' and 'A'-'F'
+    letters = digits | 0x20
+    if not (((digits >= ord('0')) & (digits <= ord('9'))) | ((letters >= ord('a')) & (letters <= ord('f')))).all():
+        raise ValueError('Found an order ID that is not a UUID string')
+    nibbles = (digits & 0x0F) + 9 * (digits >> 6)
+    return np.ascontiguousarray(nibbles[:, 0::2] << 4 | nibbles[:, 1::2]).view('V16').ravel()
 
-def arrays_to_CSV_string(**args):
-    """Arrange arrays into one string of 'newline' separated tuples (CSV format)"""
-    string = '\n'.join([','.join([str(x) for x in variables]) for variables in
-                        zip(*[args['arrays'][i] for i in range(len(args['arrays']))])])
-    return string
 
+def null_uuids(number_of_rows):
+    """Return 'number_of_rows' all-zero UUID strings, used where a dataset has no order ID field.
+    As that is rare, the array is only built the first time it is needed, then sliced for later chunks and rebuilt
+    only when a longer one is asked for"""
+    global _null_uuids
+    if len(_null_uuids) < number_of_rows:
+        _null_uuids = np.full(number_of_rows, b'00000000-0000-0000-0000-000000000000')
+    return _null_uuids[:number_of_rows]
 
-def insert_product_id(symbol, currency, symbol_name, exchange):
-    """Using 'symbol', 'currency' and 'exchange' as identifiers, generate a new product ID and insert it into the DB"""
+
+def insert_product_ids(products):
+    """Given a list of (symbol, currency, name, exchange) tuples, using 'symbol', 'currency' and 'exchange' as
+    identifiers, generate a new product ID and insert it into the DB for any product not already there.
+    Psycopg's executemany sends all the parameterised INSERTs in pipeline mode (libpq 14+) rather than waiting on one
+    round-trip each, and the IDs of the newly inserted rows are added to 'product_id_lookup' so it stays in step with
+    the 'product' table"""
+    if not products:
+        return
     cur = conn.cursor()
-    cur.execute('INSERT INTO product (unique_id, symbol, currency, name, exchange) '
-                'VALUES (DEFAULT, \'{}\', \'{}\', \'{}\', \'{}\') '
-                'ON CONFLICT DO NOTHING; '
-                .format(symbol, currency, symbol_name, exchange))
+    cur.executemany('INSERT INTO product (symbol, currency, name, exchange) '
+                    'VALUES (%s, %s, %s, %s) '
+                    'ON CONFLICT DO NOTHING '
+                    'RETURNING unique_id, symbol, currency, exchange;', products, returning=True)
+    # There is one result set per product, holding a row only if that product was really inserted
+    while True:
+        product_id_lookup.update({(symbol, currency, exchange): unique_id
+                                  for unique_id, symbol, currency, exchange in cur.fetchall()})
+        if not cur.nextset():
+            break
 
 
-def populate_product_table(symbol, currency, exchange):
-    """Using 'symbol', 'currency' and 'exchange' as identifiers, get the relevant product ID from the 'product' table"""
-    product_id = 0
-    if h5[group + '/' + table].shape[0] > 0:
-        cur = conn.cursor()
-        cur.execute('SELECT unique_id, symbol, currency, name, exchange '
-                    'FROM product '
-                    'WHERE symbol = \'{}\' AND currency = \'{}\' AND exchange = \'{}\';'.format(symbol, currency, exchange))
-        try:
-            product_id = cur.fetchone()[0]
-        except:
-            product_id = 0
-    return product_id
-
-
-# Make connection to database
-conn = psycopg2.connect(database=config.DB_NAME, user=config.DB_USER, password=config.DB_PASS, host=config.DB_HOST)
-cur = conn.cursor()
-cur.itersize = 10000
-
-# Load SQL schema to create tables.
-# Only use this while testing, as in operation, will not want to DROP tables when running this script
-# SQL_schema = open('/srv/dev-disk-by-uuid-72faeb4b-1843-416e-b797-438a1f605024/crypto_db/create_tables.sql', 'r').read()
-# SQL_schema = open('/Volumes/SSD/projects/crypto_db/create_tables.sql', 'r').read()
-# cur.execute(SQL_schema)
-
-# Lookup values to relate a product's symbol with it's full name
-symbol_name_lookup = {'BTC': 'Bitcoin', 'ETH': 'Ethereum', 'LTC': 'Litecoin', 'XLM': 'Stellar', 'OMG': 'OMG Network',
-                      'DASH': 'Dash', 'EOS': 'EOS'}
-
-# Folder with HDF5 files
-# hdf_folder = '/Volumes/SSD/data/webscraper/bulk_ingest'
-hdf_folder = '/srv/dev-disk-by-uuid-72faeb4b-1843-416e-b797-438a1f605024/websocket-scraper'
-
-for file_in_folder in os.listdir(hdf_folder):
-    if not file_in_folder.startswith('.') and file_in_folder.endswith('.h5'):
-        file_path = hdf_folder+'/'+file_in_folder
-        filename = h5py.File(file_path, 'r')
-        # Given the currently selected file in the folder, see if it has already been uploaded into the database
-        cur.execute('SELECT filename, time '
-                    'FROM file_log '
-                    'WHERE filename LIKE \'%{}\';'.format(file_in_folder))
-        filename_check = cur.fetchone()  # look up file_log.filename
-        if filename_check is None:  # If there is no record of this filename in the database, continue
+def create_bookkeeping_tables(cur):
+    """Create the tables the script keeps its own progress in, if they don't exist yet, so an existing database gains
+    them without running create_tables.sql (which DROPs all the tick data)"""
+    cur.execute('CREATE TABLE IF NOT EXISTS file_table_log ('
+                'unique_id SERIAL NOT NULL PRIMARY KEY, '
+                'filename varchar NOT NULL, '
+                'group_name varchar(8) NOT NULL, '
+                'table_name varchar(9) NOT NULL, '
+                'time TIMESTAMP NOT NULL, '
+                'UNIQUE (filename, group_name, table_name));')
+    cur.execute('CREATE TABLE IF NOT EXISTS dropped_index ('
+                'unique_id SERIAL NOT NULL PRIMARY KEY, '
+                'statement varchar NOT NULL);')
+
+
+def drop_indexes(cur, db_tables):
+    """Drop the primary key and unique constraints and the other indexes of each database table in 'db_tables' before a
+    bulk COPY, as building an index once afterwards is far cheaper than maintaining it for every row copied.
+    The statements that recreate them are saved in the 'dropped_index' table in the same transaction as the drop, so
+    they survive the process being killed before restore_indexes runs. If a previous run left statements there, its
+    indexes are still dropped and those statements are returned instead of dropping anything. With no such statements
+    and no tables in 'db_tables', nothing is dropped and nothing needs restoring"""
+    cur.execute('SELECT statement FROM dropped_index ORDER BY unique_id;')
+    statements = [statement for statement, in cur.fetchall()]
+    if statements:
+        print('Indexes dropped by an earlier run were never recreated; they will be after this run:')
+    elif not db_tables:
+        return statements
+    else:
+        cur.execute('SELECT conrelid::regclass::text, quote_ident(conname), pg_get_constraintdef(oid) '
+                    'FROM pg_constraint '
+                    'WHERE conrelid = ANY(%s::regclass[]) AND contype IN (\'p\', \'u\');', (db_tables,))
+        constraints = cur.fetchall()
+        cur.execute('SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) '
+                    'FROM pg_index '
+                    'WHERE indrelid = ANY(%s::regclass[]) '
+                    'AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid);', (db_tables,))
+        indexes = cur.fetchall()
+        statements = ['ALTER TABLE {} ADD CONSTRAINT {} {};'.format(db_table, constraint, definition)
+                      for db_table, constraint, definition in constraints] + \
+                     [definition for index, definition in indexes]
+        cur.executemany('INSERT INTO dropped_index (unique_id, statement) VALUES (DEFAULT, %s);',
+                        [(statement,) for statement in statements])
+        for db_table, constraint, definition in constraints:
+            cur.execute('ALTER TABLE {} DROP CONSTRAINT {};'.format(db_table, constraint))
+        for index, definition in indexes:
+            cur.execute('DROP INDEX {};'.format(index))
+        print('Dropped indexes for loading; they will be recreated with:')
+    for statement in statements:
+        print('  {}'.format(statement))
+    return statements
+
+
+def restore_indexes(cur, statements):
+    """Recreate the constraints and indexes dropped by drop_indexes, and clear their saved statements in the same
+    transaction"""
+    for statement in statements:
+        cur.execute(statement)
+    cur.execute('DELETE FROM dropped_index;')
+
+
+if __name__ == '__main__':
+    # Make connection to database
+    conn = connect_to_database()
+    cur = conn.cursor()
+    create_bookkeeping_tables(cur)
+    conn.commit()
+    # More memory for the session speeds up rebuilding the indexes dropped while the files are loaded
+    cur.execute('SET maintenance_work_mem = \'1GB\';')
+
+    # Using 'symbol', 'currency' and 'exchange' as identifiers, look up the product ID in memory rather than SELECTing
+    # it from the 'product' table for every (group, table) pair
+    cur.execute('SELECT unique_id, symbol, currency, exchange FROM product;')
+    product_id_lookup = {(symbol, currency, exchange): unique_id
+                         for unique_id, symbol, currency, exchange in cur.fetchall()}
+
+    # Load SQL schema to create tables.
+    # Only use this while testing, as in operation, will not want to DROP tables when running this script
+    # SQL_schema = open('/srv/dev-disk-by-uuid-72faeb4b-1843-416e-b797-438a1f605024/crypto_db/create_tables.sql', 'r').read()
+    # SQL_schema = open('/Volumes/SSD/projects/crypto_db/create_tables.sql', 'r').read()
+    # cur.execute(SQL_schema)
+
+    # Lookup values to relate a product's symbol with it's full name
+    symbol_name_lookup = {'BTC': 'Bitcoin', 'ETH': 'Ethereum', 'LTC': 'Litecoin', 'XLM': 'Stellar',
+                          'OMG': 'OMG Network', 'DASH': 'Dash', 'EOS': 'EOS'}
+
+    # Folder with HDF5 files
+    # hdf_folder = '/Volumes/SSD/data/webscraper/bulk_ingest'
+    hdf_folder = '/srv/dev-disk-by-uuid-72faeb4b-1843-416e-b797-438a1f605024/websocket-scraper'
+
+    # Work out every table still to be loaded before touching any index, so a run with nothing new to ingest, or only
+    # a few tables, rebuilds no more indexes than it has to
+    file_jobs = []
+    for file_in_folder in os.listdir(hdf_folder):
+        if not file_in_folder.startswith('.') and file_in_folder.endswith('.h5'):
+            file_path = hdf_folder+'/'+file_in_folder
+            # Given the currently selected file in the folder, see if it has already been uploaded into the database
+            cur.execute('SELECT filename, time '
+                        'FROM file_log '
+                        'WHERE filename LIKE %s;', ('%' + file_in_folder,))
+            filename_check = cur.fetchone()  # look up file_log.filename
+            if filename_check is None:  # If there is no record of this filename in the database, continue
+                with h5py.File(file_path, 'r') as h5:
+                    tables = [(group, table) for group in h5.keys() for table in h5[group]]
+                # Add the products of every table in the file, e.g. BTC_USD, in one batch before loading any data
+                products = dict.fromkeys(tuple(table.split('_')) for group, table in tables)
+                insert_product_ids([(symbol, currency, symbol_name_lookup[symbol], 'Coinbase Pro')
+                                    for symbol, currency in products])
+                conn.commit()
+
+                # Tables already committed by an earlier run that failed part-way through this file are not loaded
+                # again, as that would duplicate their rows
+                cur.execute('SELECT group_name, table_name '
+                            'FROM file_table_log '
+                            'WHERE filename LIKE %s;', ('%' + file_in_folder,))
+                loaded_tables = set(cur.fetchall())
+                for group, table in sorted(loaded_tables):
+                    print('{} tick data from {} group of {} was already ingested'.format(table, group, file_in_folder))
+
+                jobs = {}
+                for group, table in tables:
+                    if (group, table) in loaded_tables:
+                        continue
+                    symbol, currency = table.split('_')
+                    product_id = product_id_lookup.get((symbol, currency, 'Coinbase Pro'), 0)
+                    jobs[(group, table)] = (file_path, group, table, 'tick_data_'+group, product_id)
+                file_jobs.append((file_in_folder, file_path, jobs))
+
+            else:
+                print('There was already a record of {} as it was ingested on {}. Didn\'t ingest.'.format(
+                        filename_check[0], filename_check[1]))
+
+    # Indexes are dropped once for the whole folder rather than per file, as every rebuild covers all the rows in the
+    # tables, not just those of the latest file. Only the tick_data tables that will be written to are touched. The
+    # workers' COPYs must not wait on the locks taken by dropping them, hence the commit
+    restore_statements = drop_indexes(cur, sorted({job[3] for _, _, jobs in file_jobs for job in jobs.values()}))
+    conn.commit()
+    try:
+        for file_in_folder, file_path, jobs in file_jobs:
             print('Processing {}'.format(file_in_folder))
-            # Record name of file, date of upload and the time span of when the data was collected over
-            # time_span = os.stat(file_path).st_ctime - os.stat(file_path).st_birthtime
-            cur = conn.cursor()
-            cur.execute('INSERT INTO file_log (unique_id, filename, time) '
-                        'VALUES (DEFAULT, \'{}\', \'{}\')'.format(filename.filename, datetime.now(tz=None)))
             start_time = timeit.default_timer()
-            with filename as h5:
-                for index, group in enumerate(h5.keys()):
-                    for table in h5[group]:
-                        print('Loading {} tick data from {} group...'.format(table, group), end='')
-                        symbol, currency = table.split('_')
-                        insert_product_id(symbol, currency, symbol_name_lookup[symbol], 'Coinbase Pro')
-                        product_id = populate_product_table(symbol, currency, 'Coinbase Pro')
-                        assemble_data_as_string(h5, group, table, 'tick_data_'+group)
-                        conn.commit()
-                        print(' time taken: {:0.1f}s'.format(timeit.default_timer() - start_time))
+            # Every (group, table) goes into a different tick_data table or product, so they are loaded in parallel by
+            # worker processes. These are spawned rather than forked so none inherits this process' connection
+            if jobs:
+                with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(jobs), MAX_WORKERS),
+                                         mp_context=multiprocessing.get_context('spawn')) as executor:
+                    futures = {executor.submit(ingest_table, *job): key for key, job in jobs.items()}
+                    try:
+                        for future in as_completed(futures):
+                            future.result()
+                            print('Loaded {} tick data from {} group, time taken: {:0.1f}s'.format(
+                                    futures[future][1], futures[future][0], timeit.default_timer() - start_time))
+                    except BaseException:
+                        # Don't start the tables still queued. Those already running finish, and are recorded in
+                        # file_table_log if they commit
+                        for future in futures:
+                            future.cancel()
+                        raise
 
-        else:
-            print('There was already a record of {} as it was ingested on {}. Didn\'t ingest.'.format(
-                    filename_check[0], filename_check[1]))
+            # Record name of file, date of upload and the time span of when the data was collected over, only once
+            # every table of the file has been committed and recorded in file_table_log
+            # time_span = os.stat(file_path).st_ctime - os.stat(file_path).st_birthtime
+            cur.execute('INSERT INTO file_log (unique_id, filename, time) '
+                        'VALUES (DEFAULT, %s, %s)', (file_path, datetime.now(tz=None)))
+            conn.commit()
+    finally:
+        # Put the indexes back even if loading failed, so the tables are never left without them
+        if restore_statements:
+            conn.rollback()
+            restore_indexes(cur, restore_statements)
+            conn.commit()